@@ -6,6 +6,7 @@ author: suurt8ll
 author_url: https://github.com/suurt8ll
 funding_url: https://github.com/suurt8ll/open_webui_functions
 version: 0.8.0
+requirements: orjson==3.11.3
 """
 
 # The injection must follow this format (without triple quotes).
@@ -26,11 +27,12 @@ version: 0.8.0
 # IMPORTANT: Disable "Rich Text Input for Chat" in Open WebUI settings for this plugin to work correctly.
 # See https://github.com/open-webui/open-webui/issues/9759 for more.
 
-import datetime
-import inspect
 import json
+import orjson
 import re
-from pydantic import BaseModel
+import sys
+from loguru import logger
+from pydantic import BaseModel, Field
 from typing import Any, Awaitable, Callable, cast, TYPE_CHECKING
 
 from open_webui.models.functions import Functions
@@ -40,68 +42,124 @@ if TYPE_CHECKING:
     from utils.manifold_types import *  # My personal types in a separate file for more robustness.
 
 
+# Setting auditable=False avoids duplicate output for log levels that would be printed out by the main log.
+log = logger.bind(auditable=False)
+
 # --- Constants ---
+# Opening tag of an injection block, used for cheap substring checks before regex matching.
+INJECTION_MARKER = sys.intern('<details type="prompt">')
+INJECTION_END_MARKER = "</details>"
 # Regex to find the entire details block and capture its components
-# - Group 1: Full <details> block
-# - Group 2: Content inside <summary> tag (prompt title)
-# - Group 3: Content between </summary> and </details> (parameters)
+# - block: Full <details> block
+# - title: Content inside <summary> tag (prompt title)
+# - params: Content between </summary> and the closing </details> (parameters)
+# The closing tag must start its own line (leading spaces/tabs allowed), so a
+# `</details>` inside the JSON parameters, e.g. in a system prompt, does not end the block.
+# The regex runs on untrusted chat content, so title and params are tempered: they
+# cannot extend past their closing tag or into the next injection opener. Every match
+# attempt therefore stops at the next opener and a failed search stays linear, instead
+# of rescanning the rest of the message from each opener.
 DETAILS_BLOCK_REGEX = re.compile(
-    r'(<details type="prompt">\s*<summary>(.*?)</summary>(.*?)^\s*</details>)',
-    re.DOTALL | re.MULTILINE,
+    r'(?P<block><details type="prompt">\s*<summary>'
+    r'(?P<title>(?:(?!</summary>|<details type="prompt">).)*)</summary>'
+    r'(?P<params>(?:(?!\n[ \t]*</details>|<details type="prompt">).)*)'
+    r"\n[ \t]*</details>)",
+    re.DOTALL | re.ASCII,
 )
+# Regex to find the ```json fenced block inside the captured parameters.
+# It only runs on the params group, so it can never reach past the injection block.
+# The content is tempered to stop at the next fence and is stripped in Python,
+# `\s*` around a lazy group backtracks polynomially on long whitespace runs.
+JSON_FENCE_REGEX = re.compile(r"```json((?:(?!```).)*)```", re.DOTALL | re.ASCII)
 
 
 class Filter:
 
     class Valves(BaseModel):
-        pass
+        DEBUG: bool = Field(
+            default=False,
+            description="""Log detailed execution steps at INFO level.
+            Warnings and errors are logged regardless. Default value is False.""",
+        )
 
     def __init__(self):
-        valves = Functions.get_function_valves_by_id("gemini_manifold_google_genai")
+        valves = Functions.get_function_valves_by_id("system_prompt_injector")
         self.valves = self.Valves(**(valves if valves else {}))
         # Store the prompt title extracted during inlet for use in outlet
         self.prompt_title: str | None = None
         self._log("Initialized.")
 
-    def _log(self, message: str):
-        """Helper method for standardized logging."""
-        timestamp = datetime.datetime.now().isoformat()
-        caller_name = inspect.stack()[1].function
-        print(f"[{timestamp}] [{__name__}.{caller_name}] {message}")
+    def _log(self, message: str, *args: Any):
+        """
+        Helper method for diagnostic logging, only emitted when the `DEBUG` valve is
+        enabled. `args` are formatted into `message` by loguru, so nothing is built
+        when logging is off. Warnings and errors use `log` directly.
+        """
+        if self.valves.DEBUG:
+            # depth=1 attributes the record to the caller instead of this helper.
+            log.opt(depth=1).info(message, *args)
 
     def inlet(self, body: "Body") -> "Body":
         self._log("Inlet execution started.")
 
         messages: list["Message"] = body.get("messages", [])
         if not messages:
-            self._log("Warning: No messages found in the body.")
+            log.warning("No messages found in the body.")
             return body
 
         latest_system_prompt, latest_options, prompt_title = None, None, None
 
-        # Process each user message to find and extract prompt parameters.
-        # If multiple prompts are found, only the last one will be applied.
-        for idx, message in enumerate(messages):
-            if message.get("role") == "user":
-                message = cast("UserMessage", message)
-                processed_message, (sp, opt, title) = self._process_user_message(
-                    message
-                )
-                messages[idx] = processed_message  # Update message in-place
+        # Only the latest prompt injection is applied, so walk the user messages
+        # from newest to oldest and stop parsing parameters at the first match.
+        # Plain text messages without the opening tag are left untouched by
+        # `_process_user_message`, so they are skipped before the call.
+        process_user_message = self._process_user_message
+        found_idx = 0
+        for idx in range(len(messages) - 1, -1, -1):
+            message = messages[idx]
+            if message.get("role") != "user":
+                continue
+            content = message.get("content")
+            if type(content) is str and INJECTION_MARKER not in content:
+                continue
+
+            message = cast("UserMessage", message)
+            processed_message, (sp, opt, title) = process_user_message(message)
+            messages[idx] = processed_message  # Update message in-place
+
+            if title is not None:
+                latest_system_prompt = sp
+                latest_options = opt
+                prompt_title = title
+                found_idx = idx
+                break
 
-                # Track the parameters from the latest found prompt injection
-                if title is not None:
-                    latest_system_prompt = sp
-                    latest_options = opt
-                    prompt_title = title
+        # Older user messages only need their injection blocks removed.
+        for idx in range(found_idx):
+            message = messages[idx]
+            if message.get("role") != "user":
+                continue
+            content = message.get("content")
+            if type(content) is str and INJECTION_MARKER not in content:
+                continue
+
+            message = cast("UserMessage", message)
+            messages[idx] = process_user_message(message, extract_params=False)[0]
 
         # A prompt was detected in one of the user messages.
         if prompt_title:
-            self._log(f"Detected prompt '{prompt_title}'. Applying settings.")
+            self._log("Detected prompt '{}'. Applying settings.", prompt_title)
+            # The nested 'options' dict is only kept in sync for Ollama models.
+            # It is resolved once here and shared by both handlers.
+            body_options: dict[str, Any] | None = (
+                body.setdefault("options", {})  # type: ignore
+                if self._is_ollama_model(body)
+                else None
+            )
             # Apply extracted parameters to the request body
-            self._handle_system_prompt(body, latest_system_prompt)
+            self._handle_system_prompt(body, latest_system_prompt, body_options)
             if latest_options:
-                self._handle_options(body, latest_options)  # type: ignore
+                self._handle_options(body, latest_options, body_options)  # type: ignore
 
         # Store title for the outlet function only if parameters were changed.
         # `is not None` is used because an empty string for system_prompt is a valid
@@ -117,16 +175,18 @@ class Filter:
     async def outlet(
         self, body: "Body", __event_emitter__: Callable[["Event"], Awaitable[None]]
     ) -> "Body":
-        self._log("Outlet execution started.")
+        # Only add a status header if a prompt title was set during inlet,
+        # otherwise there is nothing to do.
+        if not self.prompt_title:
+            return body
 
-        # Only add a status header if a prompt title was set during inlet
-        if self.prompt_title:
-            self._log(f"Emitting status event for prompt title: '{self.prompt_title}'")
-            status_event: "StatusEvent" = {
-                "type": "status",
-                "data": {"description": self.prompt_title},
-            }
-            await __event_emitter__(status_event)
+        self._log("Outlet execution started.")
+        self._log("Emitting status event for prompt title: '{}'", self.prompt_title)
+        status_event: "StatusEvent" = {
+            "type": "status",
+            "data": {"description": self.prompt_title},
+        }
+        await __event_emitter__(status_event)
 
         self._log("Outlet execution finished.")
         return body
@@ -134,8 +194,14 @@ class Filter:
     # region ----- Helper methods inside the Filter class -----
 
     def _process_user_message(
-        self, user_message: "UserMessage"
+        self, user_message: "UserMessage", extract_params: bool = True
     ) -> tuple["UserMessage", tuple[str | None, dict[str, Any] | None, str | None]]:
+        """
+        Removes injection blocks from the message content and returns the parameters
+        of the last one found. With `extract_params=False` the blocks are only
+        stripped, without parsing their parameters.
+        """
+        system_prompt, title, options = None, None, None
         content = user_message.get("content", "")
 
         if isinstance(content, list):  # Handle mixed content (images + text)
@@ -147,8 +213,14 @@ class Filter:
             ]
 
             new_text_segments = []
-            system_prompt, title, options = None, None, None
             for ts in text_segments:
+                # Segments without an injection are kept as-is.
+                if INJECTION_MARKER not in ts:
+                    new_text_segments.append(ts)
+                    continue
+                if not extract_params:
+                    new_text_segments.append(self._strip_injection(ts))
+                    continue
                 sp, ti, mod_ts, opt = self._extract_injection_params(ts)
                 new_text_segments.append(mod_ts)
                 # Keep the parameters from the last injection block found
@@ -164,6 +236,9 @@ class Filter:
                 new_content.append({"type": "text", "text": combined_text})
             user_message["content"] = new_content
 
+        elif not extract_params:
+            user_message["content"] = self._strip_injection(content)
+
         else:  # Handle traditional text-only content
             system_prompt, title, modified_content, options = (
                 self._extract_injection_params(content)
@@ -181,29 +256,35 @@ class Filter:
         modified_content = user_message_content
         json_data: dict[str, Any] | None = None
 
-        match = DETAILS_BLOCK_REGEX.search(user_message_content)
+        match = self._search_injection(user_message_content)
         if match:
-            injection_block = match.group(1)
-            prompt_title = match.group(2).strip()
-            params_block = match.group(3).strip()
+            prompt_title = match.group("title").strip()
 
-            # Remove injection block from content
-            modified_content = user_message_content.replace(injection_block, "").strip()
+            # Remove injection block from content by slicing at the matched offsets
+            start, end = match.span("block")
+            modified_content = (
+                user_message_content[:start] + user_message_content[end:]
+            ).strip()
 
             # Extract JSON content from code block
-            json_match = re.search(r"```json\s*(.*?)\s*```", params_block, re.DOTALL)
+            json_match = JSON_FENCE_REGEX.search(match.group("params"))
             if json_match:
                 json_str = json_match.group(1).strip()
                 try:
-                    json_data = json.loads(json_str)
+                    json_data = self._load_json(json_str)
                 except json.JSONDecodeError as e:
-                    self._log(f"JSON Parse Error: {e}")
+                    log.warning("JSON Parse Error: {}", e)
+                # Both decoders only produce exact `dict` instances for objects, so a
+                # plain type comparison is enough to reject arrays and scalars.
+                if json_data and type(json_data) is not dict:
+                    log.warning("Parameters block is not a JSON object")
+                    json_data = None
                 if not json_data:
                     return (None, prompt_title, modified_content, None)
 
                 system_prompt = json_data.pop("system", None)
             else:
-                self._log("Warning: No JSON block found in parameters section")
+                log.warning("No JSON block found in parameters section")
 
         # Remove keys that have a value of None.
         if json_data:
@@ -211,37 +292,84 @@ class Filter:
 
         return (system_prompt, prompt_title, modified_content, json_data)
 
+    def _load_json(self, json_str: str) -> Any:
+        """
+        Decodes the parameters block, using orjson for speed.
+
+        orjson rejects the `NaN`/`Infinity` literals that the stdlib `json` module
+        accepts, so those blocks are retried with `json` instead of being dropped.
+        Note that orjson decodes integers beyond the 64-bit range as floats (losing
+        precision), where `json` would keep them exact.
+        """
+        try:
+            return orjson.loads(json_str)
+        except orjson.JSONDecodeError:
+            # Raises `json.JSONDecodeError` if the block is invalid for both decoders.
+            return json.loads(json_str)
+
+    def _search_injection(self, user_message_content: str) -> "re.Match[str] | None":
+        """
+        Finds the first injection block in the content.
+
+        Most messages carry no injection at all, plain substring checks are far
+        cheaper than running the regex over the whole message. The closing tag is
+        required after the first opener, and the regex scan starts at that opener.
+        """
+        marker_pos = user_message_content.find(INJECTION_MARKER)
+        if (
+            marker_pos == -1
+            or user_message_content.find(INJECTION_END_MARKER, marker_pos) == -1
+        ):
+            return None
+        return DETAILS_BLOCK_REGEX.search(user_message_content, marker_pos)
+
+    def _strip_injection(self, user_message_content: str) -> str:
+        """Removes the injection block from the content without parsing its parameters."""
+        match = self._search_injection(user_message_content)
+        if not match:
+            return user_message_content
+        start, end = match.span("block")
+        return (user_message_content[:start] + user_message_content[end:]).strip()
+
     def _is_ollama_model(self, body: "Body") -> bool:
         """Checks if the model specified in the body is owned by Ollama."""
         return body.get("metadata", {}).get("model", {}).get("owned_by") == "ollama"
 
-    def _handle_options(self, body: "Body", options: dict[str, Any]):
+    def _handle_options(
+        self,
+        body: "Body",
+        options: dict[str, Any],
+        body_options: dict[str, Any] | None,
+    ):
         """
         Applies options to the request body.
 
-        Updates top-level keys in the body. If the model is owned by Ollama,
-        it also updates the nested 'options' dictionary within the body.
+        Updates top-level keys in the body. `body_options` is the nested 'options'
+        dictionary of an Ollama model (None otherwise), it is updated as well.
         Falsy values in the input 'options' lead to key removal.
         """
-        is_ollama = self._is_ollama_model(body)
-        body_options: dict[str, Any] | None = None
-
-        if is_ollama:
-            body_options = body.setdefault("options", {})  # type: ignore
-
+        # Collect the values to set so both dicts are updated in a single call.
+        updates: dict[str, Any] = {}
         for key, value in options.items():
             if value:
-                body[key] = value
-                if is_ollama and body_options is not None:
-                    body_options[key] = value
-                self._log(f"Set option '{key}' to: {value}")
+                updates[key] = value
+                self._log("Set option '{}' to: {}", key, value)
             else:
                 body.pop(key, None)
-                if is_ollama and body_options is not None:
+                if body_options is not None:
                     body_options.pop(key, None)
-                self._log(f"Removed option '{key}' due to falsy value.")
-
-    def _handle_system_prompt(self, body: "Body", system_prompt: str | None) -> None:
+                self._log("Removed option '{}' due to falsy value.", key)
+
+        body.update(updates)  # type: ignore
+        if body_options is not None:
+            body_options.update(updates)
+
+    def _handle_system_prompt(
+        self,
+        body: "Body",
+        system_prompt: str | None,
+        body_options: dict[str, Any] | None,
+    ) -> None:
         """
         Adds, updates, or removes the system prompt in the body's 'messages' list.
 
@@ -249,37 +377,31 @@ class Filter:
         - If system_prompt is an empty string (""): Removes the system message.
         - If system_prompt is None: Does nothing to the messages list.
 
-        If the model is owned by Ollama, it also updates/removes the 'system' key
-        in the nested 'options' dictionary accordingly.
+        `body_options` is the nested 'options' dictionary of an Ollama model (None
+        otherwise), its 'system' key is updated/removed accordingly.
         """
-        is_ollama = self._is_ollama_model(body)
-        messages: list[Message] = body.setdefault("messages", [])
-
-        system_message_index = -1
-        for i, message in enumerate(messages):
-            if message.get("role") == "system":
-                system_message_index = i
-                break
-
-        body_options: dict[str, Any] | None = None
-        if is_ollama:
-            body_options = body.setdefault("options", {})  # type: ignore
-
         if system_prompt is None:
             # No action needed if no system prompt was provided in the injection block.
             return
 
-        elif system_prompt == "":
+        messages: list[Message] = body.setdefault("messages", [])
+
+        system_message_index = next(
+            (i for i, message in enumerate(messages) if message.get("role") == "system"),
+            -1,
+        )
+
+        if system_prompt == "":
             self._log("Empty system prompt provided; removing existing system message.")
             if system_message_index != -1:
                 messages.pop(system_message_index)
                 self._log("Removed system message from 'messages' list.")
-            if is_ollama and body_options is not None:
+            if body_options is not None:
                 body_options.pop("system", None)
                 self._log("Removed 'system' key from Ollama options.")
 
         else:
-            self._log(f"Applying system prompt: '{system_prompt[:70]}...'")
+            self._log("Applying system prompt: '{:.70}...'", system_prompt)
             system_message: "SystemMessage" = {
                 "role": "system",
                 "content": system_prompt,
@@ -294,7 +416,7 @@ class Filter:
                     "Inserted new system message at the beginning of 'messages' list."
                 )
 
-            if is_ollama and body_options is not None:
+            if body_options is not None:
                 body_options["system"] = system_prompt
                 self._log("Set 'system' key in Ollama options.")
 
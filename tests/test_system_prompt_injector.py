@@ -0,0 +1,338 @@
+import time
+import pytest
+from unittest.mock import patch, MagicMock, AsyncMock
+import sys
+
+# --- Mock problematic Open WebUI modules BEFORE they are imported by the plugin ---
+# Another test module may have installed its own mock already, keep it in that case.
+sys.modules.setdefault("open_webui.models.functions", MagicMock())
+
+# --- Now, the import of the plugin should use the mocks ---
+import plugins.filters.system_prompt_injector as injector
+from plugins.filters.system_prompt_injector import Filter
+
+
+# region Helpers
+def make_block(title: str, params: str | None) -> str:
+    """Builds an injection block, `params` is put in a ```json fence unless None."""
+    body = f"```json\n{params}\n```" if params is not None else "no json"
+    return f'<details type="prompt">\n<summary>{title}</summary>\n{body}\n</details>\n'
+
+
+def user(content) -> dict:
+    return {"role": "user", "content": content}
+
+
+OLLAMA_METADATA = {"model": {"owned_by": "ollama"}}
+# endregion Helpers
+
+
+# region Fixtures
+@pytest.fixture
+def filter_instance():
+    with patch.object(
+        injector.Functions, "get_function_valves_by_id", return_value=None
+    ):
+        yield Filter()
+
+
+# endregion Fixtures
+
+
+# region inlet
+def test_inlet_without_injection_leaves_body_untouched(filter_instance):
+    body = {"messages": [{"role": "system", "content": "sys"}, user("hello")]}
+
+    result = filter_instance.inlet(body)
+
+    assert result == {"messages": [{"role": "system", "content": "sys"}, user("hello")]}
+    assert filter_instance.prompt_title is None
+
+
+def test_inlet_applies_single_block(filter_instance):
+    block = make_block("My Prompt", '{"system": "Be brief.", "temperature": 0.5}')
+    body = {"messages": [{"role": "system", "content": "old"}, user(block + "hello")]}
+
+    result = filter_instance.inlet(body)
+
+    assert result["messages"] == [
+        {"role": "system", "content": "Be brief."},
+        user("hello"),
+    ]
+    assert result["temperature"] == 0.5
+    assert "options" not in result
+    assert filter_instance.prompt_title == "My Prompt"
+
+
+def test_inlet_inserts_system_message_when_missing(filter_instance):
+    body = {"messages": [user(make_block("T", '{"system": "New"}') + "hi")]}
+
+    result = filter_instance.inlet(body)
+
+    assert result["messages"] == [{"role": "system", "content": "New"}, user("hi")]
+
+
+def test_inlet_empty_system_prompt_removes_system_message(filter_instance):
+    block = make_block("T", '{"system": ""}')
+    body = {"messages": [{"role": "system", "content": "old"}, user(block + "hi")]}
+
+    result = filter_instance.inlet(body)
+
+    assert result["messages"] == [user("hi")]
+    assert filter_instance.prompt_title == "T"
+
+
+def test_inlet_latest_block_wins_and_older_are_stripped_unparsed(filter_instance):
+    older = make_block("Old", '{"system": "old", "top_k": 3}')
+    # Invalid JSON in an older message must not even be parsed.
+    oldest = make_block("Oldest", "{not json")
+    newer = make_block("New", '{"temperature": 0.9}')
+    body = {
+        "messages": [
+            user(oldest + "first"),
+            {"role": "assistant", "content": "a"},
+            user(older + "second"),
+            {"role": "assistant", "content": "b"},
+            user(newer + "third"),
+        ]
+    }
+
+    with patch.object(
+        filter_instance, "_load_json", wraps=filter_instance._load_json
+    ) as load_json:
+        result = filter_instance.inlet(body)
+
+    assert load_json.call_count == 1
+    assert [m["content"] for m in result["messages"]] == [
+        "first",
+        "a",
+        "second",
+        "b",
+        "third",
+    ]
+    assert result["temperature"] == 0.9
+    assert "top_k" not in result
+    assert filter_instance.prompt_title == "New"
+
+
+def test_inlet_fenceless_block_followed_by_code_keeps_user_text(filter_instance):
+    content = (
+        '<details type="prompt">\n<summary>T</summary>\nno json\n</details>\n'
+        'hello ```json\n{"a":1}\n``` <details><summary>x</summary>y\n</details> bye'
+    )
+    body = {"messages": [user(content)], "metadata": OLLAMA_METADATA}
+
+    result = filter_instance.inlet(body)
+
+    assert result["messages"][0]["content"] == (
+        'hello ```json\n{"a":1}\n``` <details><summary>x</summary>y\n</details> bye'
+    )
+    assert "a" not in result
+    assert "a" not in result.get("options", {})
+    assert filter_instance.prompt_title is None
+
+
+def test_inlet_fenceless_block_is_not_merged_with_next_block(filter_instance):
+    content = make_block("First", None) + make_block("Second", '{"top_k": 5}') + "hi"
+    body = {"messages": [user(content)]}
+
+    result = filter_instance.inlet(body)
+
+    # Only the first block is consumed, its lack of parameters means nothing is applied.
+    assert "top_k" not in result
+    assert result["messages"][0]["content"].startswith('<details type="prompt">')
+    assert "<summary>First</summary>" not in result["messages"][0]["content"]
+    assert filter_instance.prompt_title is None
+
+
+def test_inlet_closing_tag_inside_parameters_does_not_end_block(filter_instance):
+    params = (
+        '{"system": "Wrap reasoning in <details><summary>x</summary>...</details> tags",'
+        ' "temperature": 0.3}'
+    )
+    body = {"messages": [user(make_block("T", params) + "hello")]}
+
+    result = filter_instance.inlet(body)
+
+    assert result["messages"] == [
+        {
+            "role": "system",
+            "content": "Wrap reasoning in <details><summary>x</summary>...</details> tags",
+        },
+        user("hello"),
+    ]
+    assert result["temperature"] == 0.3
+    assert filter_instance.prompt_title == "T"
+
+
+@pytest.mark.parametrize("params", ["{not json", "[1, 2]", '"just a string"', "42"])
+def test_inlet_invalid_or_non_object_json_is_ignored(filter_instance, params):
+    body = {"messages": [user(make_block("T", params) + "hi")]}
+
+    result = filter_instance.inlet(body)
+
+    assert result == {"messages": [user("hi")]}
+    assert filter_instance.prompt_title is None
+
+
+def test_inlet_accepts_nan_literal(filter_instance):
+    body = {"messages": [user(make_block("T", '{"system": "S", "x": NaN}') + "hi")]}
+
+    result = filter_instance.inlet(body)
+
+    assert result["messages"][0] == {"role": "system", "content": "S"}
+    assert filter_instance.prompt_title == "T"
+
+
+def test_inlet_list_content_with_images(filter_instance):
+    image = {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}}
+    block = make_block("Vision", '{"temperature": 0.2}')
+    body = {"messages": [user([{"type": "text", "text": block + "describe"}, image])]}
+
+    result = filter_instance.inlet(body)
+
+    assert result["messages"][0]["content"] == [
+        image,
+        {"type": "text", "text": "describe"},
+    ]
+    assert result["temperature"] == 0.2
+    assert filter_instance.prompt_title == "Vision"
+
+
+def test_inlet_older_list_content_is_stripped(filter_instance):
+    image = {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}}
+    older = make_block("Old", '{"temperature": 0.1}')
+    body = {
+        "messages": [
+            user([{"type": "text", "text": older + "first"}, image]),
+            user(make_block("New", '{"temperature": 0.7}') + "second"),
+        ]
+    }
+
+    result = filter_instance.inlet(body)
+
+    assert result["messages"][0]["content"] == [
+        image,
+        {"type": "text", "text": "first"},
+    ]
+    assert result["temperature"] == 0.7
+
+
+def test_inlet_ollama_options_are_synced(filter_instance):
+    block = make_block("T", '{"system": "S", "temperature": 0.4, "top_k": 0}')
+    body = {
+        "messages": [user(block + "hi")],
+        "metadata": OLLAMA_METADATA,
+        "top_k": 40,
+        "options": {"top_k": 40},
+    }
+
+    result = filter_instance.inlet(body)
+
+    assert result["options"] == {"system": "S", "temperature": 0.4}
+    assert result["temperature"] == 0.4
+    # Falsy values remove the option both from the body and from Ollama options.
+    assert "top_k" not in result
+
+
+def test_inlet_ollama_empty_system_prompt_removes_option(filter_instance):
+    body = {
+        "messages": [user(make_block("T", '{"system": ""}') + "hi")],
+        "metadata": OLLAMA_METADATA,
+        "options": {"system": "old"},
+    }
+
+    result = filter_instance.inlet(body)
+
+    assert result["options"] == {}
+
+
+# endregion inlet
+
+
+# region outlet
+@pytest.mark.asyncio
+async def test_outlet_emits_status_for_stored_title(filter_instance):
+    filter_instance.inlet({"messages": [user(make_block("T", '{"top_p": 0.5}'))]})
+    emitter = AsyncMock()
+
+    result = await filter_instance.outlet({"messages": []}, emitter)
+
+    assert result == {"messages": []}
+    emitter.assert_awaited_once_with(
+        {"type": "status", "data": {"description": "T"}}
+    )
+
+
+@pytest.mark.asyncio
+async def test_outlet_without_title_does_nothing(filter_instance):
+    filter_instance.inlet({"messages": [user("hello")]})
+    emitter = AsyncMock()
+
+    await filter_instance.outlet({"messages": []}, emitter)
+
+    emitter.assert_not_awaited()
+
+
+# endregion outlet
+
+
+# region Regex performance
+OPENER = '<details type="prompt">'
+
+
+def best_time(filter_instance, content: str, repeats: int = 5) -> float:
+    """Best-of-`repeats` wall time for extracting and stripping an injection."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        filter_instance._extract_injection_params(content)
+        filter_instance._strip_injection(content)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+@pytest.mark.parametrize(
+    "build",
+    [
+        # Unterminated fence followed by a long whitespace run.
+        lambda n: f"{OPENER}\n<summary>T</summary>\n```json"
+        + " " * (20 * n)
+        + "\n</details>\nhi",
+        lambda n: f"{OPENER}\n<summary>T</summary>\n```json"
+        + " " * (20 * n)
+        + "x\n</details>\nhi",
+        # Fence-less block followed by many fenced snippets of user text.
+        lambda n: f"{OPENER}\n<summary>T</summary>\nno json\n</details>\n"
+        + "```json a ``` " * n,
+        # Many openers without a closing summary tag.
+        lambda n: f"{OPENER}<summary>" * n + "\n</details>",
+        # Many complete openers with the closing tag placed before them.
+        lambda n: "</details>" + f"{OPENER}<summary>x</summary>" * n,
+        lambda n: "\n</details>" + f"{OPENER}<summary>x</summary>" * n + "</details>",
+        # Many fence openers inside a single block.
+        lambda n: f"{OPENER}\n<summary>T</summary>\n" + "```json" * n + "\n</details>",
+    ],
+    ids=[
+        "fence-whitespace",
+        "fence-whitespace-char",
+        "fenced-snippets",
+        "openers-without-summary",
+        "openers-after-close",
+        "openers-between-closes",
+        "fence-openers",
+    ],
+)
+def test_extract_injection_params_scales_linearly_on_adversarial_input(
+    filter_instance, build
+):
+    # Compare the time at n and 2n instead of using an absolute budget, so slow CI
+    # runners don't matter. Linear matching roughly doubles, super-linear
+    # backtracking at least quadruples. The small constant absorbs timer noise.
+    n = 200
+    single = best_time(filter_instance, build(n))
+    double = best_time(filter_instance, build(2 * n))
+    assert double < 3 * single + 0.005
+
+
+# endregion Regex performance